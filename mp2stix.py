@@ -1,39 +1,245 @@
-import requests, json, uuid, re, html
-import parsedatetime
-import bibtexparser
-from bs4 import BeautifulSoup
+import json, uuid, re, html, time, os, sys, queue, threading, argparse, tempfile, hashlib
 from datetime import datetime, date
-from dateutil import parser
-from stix2 import Report, IntrusionSet, Relationship, Malware, Bundle, Identity
-from stix2.utils import parse_into_datetime
+from functools import lru_cache
+from urllib.parse import urlparse, urlsplit, parse_qsl, urlencode
 
 URL_FAMILIES = "https://malpedia.caad.fkie.fraunhofer.de/api/get/families"
 URL_BIBTEX = "https://malpedia.caad.fkie.fraunhofer.de/api/get/bib"
 URL_MISP = "https://raw.githubusercontent.com/MISP/misp-galaxy/main/clusters/threat-actor.json"
 URL_MALPEDIA = "https://malpedia.caad.fkie.fraunhofer.de"
-MALPEDIA_IDENTITY = "identity--" + str(uuid.uuid4())
-REQUESTS_TIMEOUT = 10
+MP2STIX_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, URL_MALPEDIA)
+MALPEDIA_IDENTITY = "identity--" + str(MP2STIX_NAMESPACE)
+REQUESTS_CONNECT_TIMEOUT = 5
+REQUESTS_READ_TIMEOUT = 10
+REQUESTS_TIMEOUT = (REQUESTS_CONNECT_TIMEOUT, REQUESTS_READ_TIMEOUT)
+REQUESTS_RETRIES = 2
+REQUESTS_BACKOFF = 1
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+HOST_MAX_FAILURES = 3
+METADATA_DEADLINE = 30 * 60
+METADATA_FETCH_WORKERS = 16
+METADATA_PARSE_WORKERS = os.cpu_count() or 1
+METADATA_QUEUE_SIZE = 64
+METADATA_QUEUE_POLL = 0.1
+BUNDLE_PATH = "./bundle.json"
+LOW_MEMORY_RSS_TARGET_MB = 512
+REFERENCE_FIELDS = ("date", "title", "language", "organization")
+CHECKPOINT_PATH = "./bundle.checkpoint.json"
+CHECKPOINT_INTERVAL = 60
+DELTA_PATH = "./bundle.delta.json"
+DAEMON_INTERVAL = 60 * 60
+DATE_STRATEGIES_PATH = "./date_strategies.json"
+DATE_SELECTORS = {
+    "time": lambda soup: soup.find_all(name=["time"]),
+    "class": lambda soup: soup.find_all(
+        class_=re.compile(
+            r".*(?:meta|published|time|date|header|heading|created|av b aw ax bt|card).*"
+        )
+    ),
+    "id": lambda soup: soup.find_all(
+        id=re.compile(r".*(?:authorposton|footer-info-lastmod|meta).*")
+    ),
+    "item_prop": lambda soup: soup.find_all(
+        item_prop=re.compile(r".*(?:datePublished|dateCreated).*")
+    ),
+    "datetime_arg": lambda soup: soup.find_all(datetime_arg=re.compile(r".+")),
+    "datetime": lambda soup: soup.find_all(datetime=re.compile(r".+")),
+    "text": lambda soup: [
+        t.parent
+        for t in soup.find_all(
+            string=lambda t: t
+            and re.search(r'posted|published|edited|<span class="date">', t)
+            and "\n" not in t
+        )
+    ],
+}
+
+HOST_FAILURES = {}
+HOST_FAILURES_LOCK = threading.Lock()
+DATE_STRATEGIES = {}
+metadata_deadline = None
 
 # BUILD STIX BUNDLE #
 
 
-def get_malpedia_stix():
+def get_malpedia_stix(
+    *,
+    fetch_workers=METADATA_FETCH_WORKERS,
+    parse_workers=METADATA_PARSE_WORKERS,
+    selection=None,
+    progress=None,
+    checkpoint=None,
+    resume=False,
+):
+    from stix2 import Bundle
+
+    bundle = list(
+        iter_malpedia_stix(
+            fetch_workers=fetch_workers,
+            parse_workers=parse_workers,
+            selection=selection,
+            progress=progress,
+            checkpoint=checkpoint,
+            resume=resume,
+        )
+    )
+    print("Building json bundle...")
+    json_bundle = json.loads(Bundle(*bundle).serialize())
+    return json_bundle
+
+
+def iter_malpedia_stix(
+    *,
+    fetch_workers=METADATA_FETCH_WORKERS,
+    parse_workers=METADATA_PARSE_WORKERS,
+    selection=None,
+    progress=None,
+    checkpoint=None,
+    resume=False,
+    low_memory=False,
+    cancel=None,
+):
+    families, misp, references = load_sources(low_memory)
+    if selection:
+        families = select_families(families, **selection)
+    print("Building stix objects (may take some minutes)...")
+    load_date_strategies()
+    clear_host_failures()
+    start_metadata_deadline()
+    try:
+        yield from iter_bundle(
+            families,
+            misp,
+            references,
+            fetch_workers,
+            parse_workers,
+            checkpoint=checkpoint,
+            resume=resume,
+            consume_sources=low_memory,
+            progress=progress,
+            cancel=cancel,
+        )
+    finally:
+        save_date_strategies()
+
+
+async def aiter_malpedia_stix(**kwargs):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    cancel = threading.Event()
+    objs = iter_malpedia_stix(cancel=cancel, **kwargs)
+    end = object()
+    step = None
+    with ThreadPoolExecutor(1) as builder:
+        try:
+            while True:
+                step = builder.submit(next, objs, end)
+                obj = await asyncio.wrap_future(step)
+                if obj is end:
+                    break
+                yield obj
+        finally:
+            if step is not None and not step.done():
+                # cancelled mid-step: make this build's pending fetches give up,
+                # and let the step finish before the generator can be closed
+                cancel.set()
+                await asyncio.wait([asyncio.wrap_future(step)])
+            objs.close()
+
+
+def write_low_memory_stix(
+    path=BUNDLE_PATH,
+    *,
+    fetch_workers=METADATA_FETCH_WORKERS,
+    parse_workers=METADATA_PARSE_WORKERS,
+    selection=None,
+    progress=None,
+):
+    with tempfile.TemporaryFile("w+") as store:
+        for obj in iter_malpedia_stix(
+            fetch_workers=fetch_workers,
+            parse_workers=parse_workers,
+            selection=selection,
+            progress=progress,
+            low_memory=True,
+        ):
+            store.write(obj.serialize() + "\n")
+        print("Writing json bundle...")
+        store.seek(0)
+        stream_bundle(store, path)
+    report_peak_rss()
+
+
+def load_sources(low_memory=False):
+    import requests
+
     print("Accessing necessesary sources...")
+    references = parse_references(requests.get(URL_BIBTEX).content)
+    families = requests.get(URL_FAMILIES).json()
+    misp = disambiguate_aliases(requests.get(URL_MISP).json())
+    if low_memory:
+        misp, references = compact_sources(misp, references)
+    return families, misp, references
+
+
+def parse_references(content):
+    import bibtexparser
+
     bibtex_parser = bibtexparser.bparser.BibTexParser()
     bibtex_parser.ignore_nonstandard_types = False
-    references = {
-        o["url"]: o
-        for o in bibtexparser.loads(
-            requests.get(URL_BIBTEX).content, bibtex_parser
-        ).entries
+    return {o["url"]: o for o in bibtexparser.loads(content, bibtex_parser).entries}
+
+
+def compact_sources(misp, references):
+    compact_misp = {"values": []}
+    for obj in misp["values"]:
+        compact_obj = {key: obj[key] for key in ("value", "description") if key in obj}
+        if "meta" in obj and "synonyms" in obj["meta"]:
+            compact_obj["meta"] = {"synonyms": obj["meta"]["synonyms"]}
+        compact_misp["values"].append(compact_obj)
+    compact_references = {
+        url: {key: entry[key] for key in REFERENCE_FIELDS if key in entry}
+        for url, entry in references.items()
     }
-    families = requests.get(URL_FAMILIES).json()
-    misp = disambiguate_aliases(requests.get(URL_MISP).json())
-    print("Building stix objects (may take some minutes)...")
-    bundle = build_bundle(families, misp, references)
-    print("Building json bundle...")
-    json_bundle = json.loads(Bundle(*bundle).serialize())
-    return json_bundle
+    return compact_misp, compact_references
+
+
+def stream_bundle(lines, path):
+    with open(path, "w") as f:
+        f.write('{\n    "type": "bundle",\n')
+        f.write('    "id": "bundle--' + str(uuid.uuid4()) + '",\n')
+        f.write('    "objects": [')
+        separator = "\n"
+        for line in lines:
+            obj = json.dumps(json.loads(line), indent=4)
+            f.write(separator + "\n".join("        " + row for row in obj.splitlines()))
+            separator = ",\n"
+        f.write("\n    ]\n}\n")
+
+
+def report_peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale
+    workers_rss_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale
+    print(
+        "Peak RSS: "
+        + str(peak_rss_mb)
+        + " MB (largest parse worker: "
+        + str(workers_rss_mb)
+        + " MB)"
+    )
+    if peak_rss_mb > LOW_MEMORY_RSS_TARGET_MB:
+        print(
+            "Warning: peak RSS exceeds the target of "
+            + str(LOW_MEMORY_RSS_TARGET_MB)
+            + " MB"
+        )
 
 
 def disambiguate_aliases(misp):
@@ -50,22 +256,152 @@ def disambiguate_aliases(misp):
     return misp
 
 
-def build_bundle(families, misp, references):
-    malpedia = Identity(
-        id=MALPEDIA_IDENTITY,
-        identity_class="organization",
-        name="Malpedia (Fraunhofer FKIE)",
+def build_bundle(
+    families,
+    misp,
+    references,
+    fetch_workers=METADATA_FETCH_WORKERS,
+    parse_workers=METADATA_PARSE_WORKERS,
+    checkpoint=None,
+    resume=False,
+    metadata=None,
+):
+    return list(
+        iter_bundle(
+            families,
+            misp,
+            references,
+            fetch_workers,
+            parse_workers,
+            checkpoint=checkpoint,
+            resume=resume,
+            metadata=metadata,
+        )
     )
-    bundle = [malpedia]
-    for key in families:
-        malware = build_malware(key, families[key])
-        intrusion_sets = build_intrusion_sets(families[key], misp, bundle)
-        relationships = build_relationships(malware, intrusion_sets, families[key])
-        reports = build_reports(malware, families[key], bundle, references)
-        bundle = integrate_new_objs(
-            [malware] + intrusion_sets + relationships + reports, bundle
+
+
+def iter_bundle(
+    families,
+    misp,
+    references,
+    fetch_workers=METADATA_FETCH_WORKERS,
+    parse_workers=METADATA_PARSE_WORKERS,
+    checkpoint=None,
+    resume=False,
+    metadata=None,
+    consume_sources=False,
+    progress=None,
+    cancel=None,
+):
+    from stix2 import Identity
+
+    if resume and checkpoint and os.path.exists(checkpoint):
+        families_done, built, metadata = load_checkpoint(checkpoint)
+        expire_fallback_metadata(metadata)
+        if not set(families_done) <= set(families):
+            raise ValueError(
+                "Checkpoint "
+                + checkpoint
+                + " contains families outside of the current selection"
+            )
+    else:
+        malpedia = Identity(
+            id=MALPEDIA_IDENTITY,
+            identity_class="organization",
+            name="Malpedia (Fraunhofer FKIE)",
         )
-    return bundle
+        families_done, built = [], [malpedia]
+        metadata = {} if metadata is None else metadata
+    last_checkpoint = time.monotonic()
+
+    def save_progress(force=False):
+        nonlocal last_checkpoint
+        if not checkpoint:
+            return
+        if force or time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+            save_checkpoint(checkpoint, families_done, built, metadata)
+            last_checkpoint = time.monotonic()
+
+    def report_progress(stage, done, total):
+        if progress:
+            progress(stage, done, total)
+
+    resolved_urls = 0
+
+    def metadata_resolved(url, meta):
+        nonlocal resolved_urls
+        resolved_urls += 1
+        save_progress()
+        report_progress("metadata", resolved_urls, len(fetch_urls))
+
+    yield from built
+    urls, url_families = plan_urls(families, references)
+    pairs, updated = plan_attributions(families)
+    built_ids = {obj["id"] for obj in built}
+    intrusion_sets = resolve_intrusion_sets(pairs, misp, built)
+    new_intrusion_sets = [
+        obj for obj in intrusion_sets.values() if obj["id"] not in built_ids
+    ]
+    yield from new_intrusion_sets
+    malwares = {
+        obj["name"]: {"id": obj["id"]} for obj in built if obj["type"] == "malware"
+    }
+    built = built + new_intrusion_sets if checkpoint else []
+    total_families = len(families)
+    done_keys = set(families_done)
+    for key in list(families):
+        if key in done_keys:
+            continue
+        family = families.pop(key) if consume_sources else families[key]
+        malware = build_malware(key, family)
+        yield malware
+        if checkpoint:
+            built.append(malware)
+        malwares[key] = {"id": malware["id"]}
+        families_done.append(key)
+        save_progress()
+        report_progress("families", len(families_done), total_families)
+    yield from build_all_relationships(pairs, updated, malwares, intrusion_sets)
+    save_progress(force=True)
+    fetch_urls = [
+        url for url in urls.values() if url not in references and url not in metadata
+    ]
+    resolve_metadata(
+        fetch_urls,
+        fetch_workers,
+        parse_workers,
+        metadata=metadata,
+        on_resolved=metadata_resolved,
+        cancel=cancel,
+    )
+    save_progress(force=True)
+    reports = build_reports(malwares, urls, url_families, references, [], metadata)
+    for done, report in enumerate(reports, 1):
+        yield report
+        report_progress("reports", done, len(urls))
+
+
+def save_checkpoint(path, families_done, bundle, metadata):
+    with open(path + ".tmp", "w") as f:
+        json.dump(
+            {
+                "families": families_done,
+                "objects": [json.loads(obj.serialize()) for obj in bundle],
+                "metadata": metadata,
+            },
+            f,
+        )
+    os.replace(path + ".tmp", path)
+
+
+def load_checkpoint(path):
+    from stix2 import parse
+
+    with open(path) as f:
+        state = json.load(f)
+    bundle = [parse(obj, allow_custom=True) for obj in state["objects"]]
+    metadata = {url: tuple(meta) for url, meta in state["metadata"].items()}
+    return state["families"], bundle, metadata
 
 
 def integrate_new_objs(new_objs, bundle):
@@ -78,10 +414,47 @@ def integrate_new_objs(new_objs, bundle):
     return bundle
 
 
+# SELECT FAMILIES #
+
+
+def select_families(families, keys=(), patterns=(), actors=(), shared_reports=False):
+    patterns = [re.compile(pattern, re.IGNORECASE) for pattern in patterns]
+    actors = {actor.lower() for actor in actors}
+    selected = {
+        key: family
+        for key, family in families.items()
+        if key in keys
+        or any(
+            pattern.search(name)
+            for pattern in patterns
+            for name in [key, family["common_name"]] + family["alt_names"]
+        )
+        or actors.intersection(actor.lower() for actor in family["attribution"])
+    }
+    if shared_reports:
+        urls = {
+            canonicalize_url(url)
+            for family in selected.values()
+            for url in family["urls"]
+        }
+        selected = {
+            key: family
+            for key, family in families.items()
+            if key in selected
+            or urls.intersection(canonicalize_url(url) for url in family["urls"])
+        }
+    print("Selected " + str(len(selected)) + " of " + str(len(families)) + " families")
+    return selected
+
+
 # BUILD MALWARE #
 
 
 def build_malware(name_key, obj):
+    from dateutil import parser
+    from stix2 import Malware
+    from stix2.utils import parse_into_datetime
+
     malpedia_link = URL_MALPEDIA + "/details/" + name_key
     description = (
         "This Malware object was created based on information from "
@@ -94,7 +467,7 @@ def build_malware(name_key, obj):
     if obj["description"]:
         description = obj["description"] + "\n" + description
     malware = Malware(
-        id="malware--" + str(uuid.uuid4()),
+        id="malware--" + str(uuid.uuid5(MP2STIX_NAMESPACE, name_key)),
         aliases=obj["alt_names"] + [obj["common_name"]],
         type="malware",
         name=name_key,
@@ -112,22 +485,35 @@ def build_malware(name_key, obj):
 # BUILD INTRUSION SETS #
 
 
-def build_intrusion_sets(malware, misp, bundle):
-    intrusion_sets = []
-    for iset in malware["attribution"]:
-        existing_objs = [
-            obj
-            for obj in bundle
-            if obj["type"] == "intrusion-set" and obj["name"].lower() == iset.lower()
-        ]
-        if existing_objs:
-            intrusion_sets.extend(existing_objs)
-        else:
-            intrusion_sets.append(compile_intrusion_set(misp, iset))
+def plan_attributions(families):
+    pairs = [(actor, key) for key in families for actor in families[key]["attribution"]]
+    updated = {key: families[key]["updated"] for key in families}
+    return pairs, updated
+
+
+def index_misp(misp):
+    misp_index = {}
+    for obj in misp["values"]:
+        misp_index.setdefault(obj["value"].lower(), []).append(obj)
+    return misp_index
+
+
+def resolve_intrusion_sets(pairs, misp, bundle):
+    intrusion_sets = {
+        obj["name"].lower(): obj for obj in bundle if obj["type"] == "intrusion-set"
+    }
+    misp_index = index_misp(misp) if pairs else {}
+    for actor, _ in pairs:
+        if actor.lower() not in intrusion_sets:
+            intrusion_sets[actor.lower()] = compile_intrusion_set(
+                {"values": misp_index.get(actor.lower(), [])}, actor
+            )
     return intrusion_sets
 
 
 def compile_intrusion_set(misp, actor):
+    from stix2 import IntrusionSet
+
     misp_objs = [obj for obj in misp["values"] if obj["value"].lower() == actor.lower()]
     aliases = [
         obj["meta"]["synonyms"]
@@ -146,7 +532,7 @@ def compile_intrusion_set(misp, actor):
     if descriptions:
         description = descriptions[0] + "\n" + description
     intrusion_set = IntrusionSet(
-        id="intrusion-set--" + str(uuid.uuid4()),
+        id="intrusion-set--" + str(uuid.uuid5(MP2STIX_NAMESPACE, actor.lower())),
         type="intrusion-set",
         name=actor,
         description=description,
@@ -160,16 +546,36 @@ def compile_intrusion_set(misp, actor):
 # BUILD RELATIONSHIPS #
 
 
+def build_all_relationships(pairs, updated, malwares, intrusion_sets):
+    attributed = {}
+    for actor, key in pairs:
+        attributed.setdefault(key, []).append(intrusion_sets[actor.lower()])
+    for key, family_intrusion_sets in attributed.items():
+        yield from build_relationships(
+            malwares[key],
+            integrate_new_objs(family_intrusion_sets, []),
+            {"updated": updated[key]},
+        )
+
+
 def build_relationships(malware, intrusion_sets, mp_obj):
+    from dateutil import parser
+    from stix2 import Relationship
+    from stix2.utils import parse_into_datetime
+
     description = "Relationship stated on " + URL_MALPEDIA
+    timestamp = None
     if mp_obj["updated"]:
         description += ". Last update: " + mp_obj["updated"] + "."
-        parsed_updated = parser.parse(mp_obj["updated"])
+        timestamp = parse_into_datetime(parser.parse(mp_obj["updated"]))
     rels = []
     for intrusion_set in intrusion_sets:
         rels.append(
             Relationship(
-                id="relationship--" + str(uuid.uuid4()),
+                id="relationship--"
+                + str(
+                    uuid.uuid5(MP2STIX_NAMESPACE, intrusion_set["id"] + malware["id"])
+                ),
                 type="relationship",
                 relationship_type="uses",
                 source_ref=intrusion_set["id"],
@@ -177,12 +583,8 @@ def build_relationships(malware, intrusion_sets, mp_obj):
                 description=description,
                 confidence=95,
                 created_by_ref=MALPEDIA_IDENTITY,
-                modified=parse_into_datetime(parsed_updated)
-                if mp_obj["updated"]
-                else None,
-                created=parse_into_datetime(parsed_updated)
-                if mp_obj["updated"]
-                else None,
+                modified=timestamp,
+                created=timestamp,
             )
         )
     return rels
@@ -191,38 +593,62 @@ def build_relationships(malware, intrusion_sets, mp_obj):
 # BUILD REPORTS #
 
 
-def build_reports(malware, mp_obj, bundle, references):
-    new_reports = []
-    for url in mp_obj["urls"]:
-        existing_objs = [
-            stix_obj
-            for stix_obj in bundle + new_reports
-            if stix_obj["type"] == "report"
-            and url in str(stix_obj["external_references"])
+def plan_urls(families, references):
+    urls = {}
+    url_families = {}
+    for key in families:
+        for url in families[key]["urls"]:
+            canonical = canonicalize_url(url)
+            if canonical not in urls or (
+                url in references and urls[canonical] not in references
+            ):
+                urls[canonical] = url
+            keys = url_families.setdefault(canonical, [])
+            if key not in keys:
+                keys.append(key)
+    return urls, url_families
+
+
+@lru_cache(maxsize=None)
+def canonicalize_url(url):
+    try:
+        parts = urlsplit(url.strip())
+    except ValueError:
+        return url.strip()
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    if host.endswith((":80", ":443")):
+        host = host.rsplit(":", 1)[0]
+    query = urlencode(
+        [
+            (k, v)
+            for k, v in parse_qsl(parts.query, keep_blank_values=True)
+            if not k.lower().startswith("utm_")
         ]
-        if existing_objs:
-            new_reports.extend(add_object_ref(existing_objs, malware))
-        else:
-            new_reports.append(
-                disambiguate_report_names(
-                    compile_report(url, references, [malware]), bundle, new_reports
-                )
-            )
-    return new_reports
+    )
+    return host + parts.path.rstrip("/") + ("?" + query if query else "")
 
 
-def add_object_ref(report_objs, malware):
-    enriched_reports = []
-    for stix_obj in report_objs:
-        enriched_reports.append(
-            stix_obj.new_version(
-                object_refs=list(set(stix_obj["object_refs"] + [malware["id"]]))
-            )
+def build_reports(malwares, urls, url_families, references, bundle, metadata=None):
+    report_names = []
+    for canonical, url in urls.items():
+        report = compile_report(
+            url,
+            references,
+            [malwares[key] for key in url_families[canonical]],
+            metadata,
         )
-    return enriched_reports
+        report = disambiguate_report_names(report, bundle, report_names)
+        report_names.append({"type": "report", "name": report["name"]})
+        yield report
+
 
+def compile_report(url, references, contained_objs, metadata=None):
+    from dateutil import parser
+    from stix2 import Report
+    from stix2.utils import parse_into_datetime
 
-def compile_report(url, references, contained_objs):
     description = ""
     if url in references.keys():
         date = parse_into_datetime(
@@ -235,11 +661,13 @@ def compile_report(url, references, contained_objs):
             description += "Organization: " + references[url]["organization"]
         if description.endswith("\n"):
             description = description[:-1]
+    elif metadata and url in metadata:
+        date, title = metadata[url]
     else:
         date, title = get_alt_meta(url)
     report = Report(
         type="report",
-        id="report--" + str(uuid.uuid4()),
+        id="report--" + str(uuid.uuid5(MP2STIX_NAMESPACE, canonicalize_url(url))),
         name=title.strip(),
         description=description,
         external_references=[{"source_name": title, "url": url}],
@@ -262,14 +690,113 @@ def compile_report(url, references, contained_objs):
 #     return parse_into_datetime(parser.parse(string))
 
 
+def resolve_metadata(
+    urls,
+    fetch_workers=METADATA_FETCH_WORKERS,
+    parse_workers=METADATA_PARSE_WORKERS,
+    queue_size=METADATA_QUEUE_SIZE,
+    metadata=None,
+    on_resolved=None,
+    cancel=None,
+):
+    from concurrent.futures import (
+        ThreadPoolExecutor,
+        ProcessPoolExecutor,
+        FIRST_COMPLETED,
+        ALL_COMPLETED,
+        wait,
+    )
+    from concurrent.futures.process import BrokenProcessPool
+
+    metadata = {} if metadata is None else metadata
+    if not urls:
+        return metadata
+    bodies = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def resolved(url, meta):
+        date, title, selector = meta
+        if selector:
+            DATE_STRATEGIES[url_host(url)] = selector
+        metadata[url] = (date, title)
+        if on_resolved:
+            on_resolved(url, metadata[url])
+
+    def download(url):
+        body = None
+        try:
+            if not stop.is_set():
+                body = fetch_body(url, cancel)
+        finally:
+            # the consumer may have given up, so never block on a full queue
+            while not stop.is_set():
+                try:
+                    bodies.put((url, body), timeout=METADATA_QUEUE_POLL)
+                    break
+                except queue.Full:
+                    pass
+
+    def collect(futures, return_when):
+        done, _ = wait(futures, return_when=return_when)
+        for future in done:
+            url = futures.pop(future)
+            try:
+                meta = future.result()
+            except BrokenProcessPool:
+                raise
+            except Exception:
+                meta = parse_alt_meta(url, None)
+            resolved(url, meta)
+
+    with ThreadPoolExecutor(fetch_workers) as fetchers, ProcessPoolExecutor(
+        parse_workers
+    ) as parsers:
+        try:
+            for url in urls:
+                fetchers.submit(download, url)
+            parsing = {}
+            for _ in urls:
+                url, body = bodies.get()
+                if body is None:
+                    resolved(url, parse_alt_meta(url, body))
+                    continue
+                strategy = DATE_STRATEGIES.get(url_host(url))
+                parsing[parsers.submit(parse_alt_meta, url, body, strategy)] = url
+                if len(parsing) >= queue_size:
+                    collect(parsing, FIRST_COMPLETED)
+            if parsing:
+                collect(parsing, ALL_COMPLETED)
+        finally:
+            stop.set()
+            fetchers.shutdown(wait=False, cancel_futures=True)
+            parsers.shutdown(wait=False, cancel_futures=True)
+    return metadata
+
+
 def get_alt_meta(url):
-    try:
-        request = requests.get(url, timeout=REQUESTS_TIMEOUT)
-    except:
-        request = None
-    if request and request.status_code < 400 and not url.endswith(".pdf"):
-        date = get_date_from_html(request.content)
-        title_match = re.search(r"<title>(.*?)</title>", request.text, re.DOTALL)
+    date, title, _ = parse_alt_meta(url, fetch_body(url))
+    return date, title
+
+
+def fetch_body(url, cancel=None):
+    if url.endswith(".pdf"):
+        return None
+    request = fetch_url(url, cancel)
+    if request and request.status_code < 400:
+        return request.content, request.encoding
+    return None
+
+
+def parse_alt_meta(url, body, strategy=None):
+    selector = None
+    if body:
+        content, encoding = body
+        try:
+            text = content.decode(encoding or "utf-8", errors="replace")
+        except LookupError:
+            text = content.decode("utf-8", errors="replace")
+        date, selector = get_date_from_html(content, strategy)
+        title_match = re.search(r"<title>(.*?)</title>", text, re.DOTALL)
         title = (
             html.unescape(title_match.group(1).replace("\n", " "))[:500]
             if title_match and len(title_match.group(1)) > 3
@@ -283,64 +810,124 @@ def get_alt_meta(url):
             if title_match and len(title_match.group(1)) > 3
             else url
         )
-    return date, title
+    return date, title, selector
+
+
+def start_metadata_deadline(seconds=METADATA_DEADLINE):
+    global metadata_deadline
+    metadata_deadline = time.monotonic() + seconds if seconds is not None else None
+
+
+def metadata_time_left():
+    if metadata_deadline is None:
+        return None
+    return max(metadata_deadline - time.monotonic(), 0)
+
+
+def url_host(url):
+    try:
+        return urlparse(url).netloc.lower()
+    except ValueError:
+        return ""
+
+
+def fetch_url(url, cancel=None):
+    import requests
+
+    host = url_host(url)
+    request = None
+    for attempt in range(REQUESTS_RETRIES + 1):
+        if (
+            metadata_time_left() == 0
+            or (cancel is not None and cancel.is_set())
+            or HOST_FAILURES.get(host, 0) >= HOST_MAX_FAILURES
+        ):
+            return None
+        try:
+            request = requests.get(url, timeout=REQUESTS_TIMEOUT)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+            request = None
+        except Exception:
+            return None
+        else:
+            if request.status_code not in RETRY_STATUS_CODES:
+                with HOST_FAILURES_LOCK:
+                    HOST_FAILURES.pop(host, None)
+                return request
+        if attempt < REQUESTS_RETRIES:
+            backoff = REQUESTS_BACKOFF * 2**attempt
+            time_left = metadata_time_left()
+            time.sleep(backoff if time_left is None else min(backoff, time_left))
+    with HOST_FAILURES_LOCK:
+        HOST_FAILURES[host] = HOST_FAILURES.get(host, 0) + 1
+    return request
+
+
+def clear_host_failures():
+    with HOST_FAILURES_LOCK:
+        HOST_FAILURES.clear()
+
+
+def load_date_strategies(path=DATE_STRATEGIES_PATH):
+    if os.path.exists(path):
+        with open(path) as f:
+            DATE_STRATEGIES.update(json.load(f))
 
 
-def get_date_from_html(html):
-    html_elements = find_date_elements(html)
-    for html_element in html_elements:
-        time_struct, parse_status = parsedatetime.Calendar().parse(html_element.text)
-        time = datetime(*time_struct[:6])
-        # time = parse_date(html_element.text)
-        if time.date() < date.today():
-            return time.strftime("%Y-%m-%dT%H:%M:%SZ")
-    return "1970-01-01T00:00:00Z"
+def save_date_strategies(path=DATE_STRATEGIES_PATH):
+    write_json_atomic(path, DATE_STRATEGIES)
+
+
+def get_date_from_html(html, strategy=None):
+    import parsedatetime
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, features="lxml")
+    calendar = parsedatetime.Calendar()
+    attempts = [list(DATE_SELECTORS)]
+    if strategy in DATE_SELECTORS:
+        attempts.insert(0, [strategy])
+    for selectors in attempts:
+        for html_element, selector in find_date_candidates(soup, selectors):
+            time_struct, parse_status = calendar.parse(html_element.text)
+            time = datetime(*time_struct[:6])
+            # time = parse_date(html_element.text)
+            if time.date() < date.today():
+                return time.strftime("%Y-%m-%dT%H:%M:%SZ"), selector
+    return "1970-01-01T00:00:00Z", None
 
 
 def find_date_elements(html):
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(html, features="lxml")
-    html_elements = soup.find_all(name=["time"])
-    html_elements.extend(
-        soup.find_all(
-            class_=re.compile(
-                r".*(?:meta|published|time|date|header|heading|created|av b aw ax bt|card).*"
-            )
-        )
-    )
-    html_elements.extend(
-        soup.find_all(id=re.compile(r".*(?:authorposton|footer-info-lastmod|meta).*"))
-    )
-    html_elements.extend(
-        soup.find_all(item_prop=re.compile(r".*(?:datePublished|dateCreated).*"))
-    )
-    html_elements.extend(soup.find_all(datetime_arg=re.compile(r".+")))
-    html_elements.extend(soup.find_all(datetime=re.compile(r".+")))
-    html_elements.extend(
-        [
-            t.parent
-            for t in soup.find_all(
-                string=lambda t: t
-                and re.search(r'posted|published|edited|<span class="date">', t)
-                and "\n" not in t
-            )
-        ]
-    )
-    for element in html_elements.copy():
-        if element.name == "body":
-            html_elements.remove(element)
-        elif element.find_parent(
-            class_=re.compile(
-                r".*(?:revision|comment|sidebar(?!s)|preview|related|footer|referenc).*"
-            ),
-            name=re.compile(r"^(?!body).*"),
-        ):
-            html_elements.remove(element)
-        elif element.find_parent(name=re.compile(r".*(?:aside|revision|history).*")):
-            html_elements.remove(element)
-        elif [w for w in ["related"] if w in element.name]:
-            html_elements.remove(element)
-    html_elements.sort(key=lambda x: len(x.text))
-    return html_elements
+    return [element for element, _ in find_date_candidates(soup, DATE_SELECTORS)]
+
+
+def find_date_candidates(soup, selectors):
+    candidates = [
+        (element, selector)
+        for selector in selectors
+        for element in DATE_SELECTORS[selector](soup)
+        if is_date_element(element)
+    ]
+    candidates.sort(key=lambda x: len(x[0].text))
+    return candidates
+
+
+def is_date_element(element):
+    if element.name == "body":
+        return False
+    elif element.find_parent(
+        class_=re.compile(
+            r".*(?:revision|comment|sidebar(?!s)|preview|related|footer|referenc).*"
+        ),
+        name=re.compile(r"^(?!body).*"),
+    ):
+        return False
+    elif element.find_parent(name=re.compile(r".*(?:aside|revision|history).*")):
+        return False
+    return "related" not in element.name
 
 
 def disambiguate_report_names(new_report, bundle, reports):
@@ -364,13 +951,214 @@ def disambiguate_report_names(new_report, bundle, reports):
     return new_report
 
 
+# DAEMON #
+
+
+def run_daemon(
+    interval=DAEMON_INTERVAL,
+    path=BUNDLE_PATH,
+    delta_path=DELTA_PATH,
+    fetch_workers=METADATA_FETCH_WORKERS,
+    parse_workers=METADATA_PARSE_WORKERS,
+    selection=None,
+):
+    sources, validators, metadata = {}, {}, {}
+    published = load_published(path)
+    load_date_strategies()
+    while True:
+        try:
+            fresh = poll_sources(sources, validators)
+            if fresh:
+                print("Sources changed, rebuilding stix objects...")
+                clear_host_failures()
+                expire_fallback_metadata(metadata)
+                start_metadata_deadline()
+                families = sources["families"]
+                if selection:
+                    families = select_families(families, **selection)
+                bundle = build_bundle(
+                    families,
+                    sources["misp"],
+                    sources["references"],
+                    fetch_workers=fetch_workers,
+                    parse_workers=parse_workers,
+                    metadata=metadata,
+                )
+                save_date_strategies()
+                published = publish_update(published, bundle, path, delta_path)
+                validators.update(fresh)
+        except Exception as e:
+            print("Update failed: " + repr(e))
+        time.sleep(interval)
+
+
+def poll_sources(sources, validators):
+    fresh = {}
+    for name, url, parse in (
+        ("families", URL_FAMILIES, lambda response: response.json()),
+        ("misp", URL_MISP, lambda response: disambiguate_aliases(response.json())),
+        ("references", URL_BIBTEX, lambda response: parse_references(response.content)),
+    ):
+        fetched = fetch_source(url, validators)
+        if fetched is not None:
+            response, fresh[url] = fetched
+            sources[name] = parse(response)
+    return fresh
+
+
+def fetch_source(url, validators):
+    import requests
+
+    headers = {}
+    if "etag" in validators.get(url, {}):
+        headers["If-None-Match"] = validators[url]["etag"]
+    if "last_modified" in validators.get(url, {}):
+        headers["If-Modified-Since"] = validators[url]["last_modified"]
+    response = requests.get(url, headers=headers, timeout=REQUESTS_TIMEOUT)
+    if response.status_code == 304:
+        return None
+    response.raise_for_status()
+    digest = hashlib.sha256(response.content).hexdigest()
+    if validators.get(url, {}).get("digest") == digest:
+        return None
+    validator = {"digest": digest}
+    if "ETag" in response.headers:
+        validator["etag"] = response.headers["ETag"]
+    if "Last-Modified" in response.headers:
+        validator["last_modified"] = response.headers["Last-Modified"]
+    return response, validator
+
+
+def expire_fallback_metadata(metadata):
+    for url, meta in list(metadata.items()):
+        if tuple(meta) == parse_alt_meta(url, None)[:2]:
+            del metadata[url]
+
+
+def load_published(path):
+    from stix2 import parse
+
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        objs = json.load(f)["objects"]
+    return {obj["id"]: parse(obj, allow_custom=True) for obj in objs}
+
+
+def publish_update(published, bundle, path, delta_path):
+    from stix2 import Bundle
+
+    objs, changed = merge_versions(published, bundle)
+    ids = {obj["id"] for obj in objs}
+    removed = [obj_id for obj_id in published if obj_id not in ids]
+    if not changed and not removed:
+        print("No changes to publish.")
+        return published
+    write_json_atomic(path, json.loads(Bundle(*objs).serialize()))
+    write_json_atomic(
+        delta_path,
+        {
+            "created": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "objects": [json.loads(obj.serialize()) for obj in changed],
+            "removed": removed,
+        },
+    )
+    print(
+        "Published "
+        + str(len(changed))
+        + " changed and "
+        + str(len(removed))
+        + " removed objects."
+    )
+    return {obj["id"]: obj for obj in objs}
+
+
+def merge_versions(published, bundle):
+    objs, changed = [], []
+    for obj in bundle:
+        previous = published.get(obj["id"])
+        if previous is None:
+            objs.append(obj)
+            changed.append(obj)
+            continue
+        # compare serialized forms, timestamps parsed back from json are tz-aware
+        fields = json.loads(obj.serialize())
+        previous_fields = json.loads(previous.serialize())
+        updates = {
+            key: obj.get(key)
+            for key in set(fields) | set(previous_fields)
+            if key not in ("created", "modified")
+            and fields.get(key) != previous_fields.get(key)
+        }
+        if updates:
+            obj = previous.new_version(**updates)
+            changed.append(obj)
+        else:
+            obj = previous
+        objs.append(obj)
+    return objs, changed
+
+
+def write_json_atomic(path, data):
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f, indent=4)
+    os.replace(path + ".tmp", path)
+
+
 # MAIN #
 
 
 def main():
-    stix = get_malpedia_stix()
-    with open("./bundle.json", "w") as f:
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--fetch-workers", type=int, default=METADATA_FETCH_WORKERS)
+    arg_parser.add_argument("--parse-workers", type=int, default=METADATA_PARSE_WORKERS)
+    arg_parser.add_argument("--low-memory", action="store_true")
+    arg_parser.add_argument("--resume", action="store_true")
+    arg_parser.add_argument("--daemon", action="store_true")
+    arg_parser.add_argument("--interval", type=int, default=DAEMON_INTERVAL)
+    arg_parser.add_argument("--family", action="append", default=[])
+    arg_parser.add_argument("--match", action="append", default=[])
+    arg_parser.add_argument("--actor", action="append", default=[])
+    arg_parser.add_argument("--with-shared-reports", action="store_true")
+    args = arg_parser.parse_args()
+    selection = None
+    if args.family or args.match or args.actor:
+        selection = {
+            "keys": args.family,
+            "patterns": args.match,
+            "actors": args.actor,
+            "shared_reports": args.with_shared_reports,
+        }
+    if args.daemon:
+        run_daemon(
+            args.interval,
+            BUNDLE_PATH,
+            DELTA_PATH,
+            args.fetch_workers,
+            args.parse_workers,
+            selection,
+        )
+        return
+    if args.low_memory:
+        if args.resume:
+            arg_parser.error("--resume is not supported with --low-memory")
+        write_low_memory_stix(
+            BUNDLE_PATH,
+            fetch_workers=args.fetch_workers,
+            parse_workers=args.parse_workers,
+            selection=selection,
+        )
+        return
+    stix = get_malpedia_stix(
+        fetch_workers=args.fetch_workers,
+        parse_workers=args.parse_workers,
+        selection=selection,
+        checkpoint=CHECKPOINT_PATH,
+        resume=args.resume,
+    )
+    with open(BUNDLE_PATH, "w") as f:
         json.dump(stix, f, indent=4)
+    os.remove(CHECKPOINT_PATH)
 
 
 if __name__ == "__main__":
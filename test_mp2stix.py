@@ -1,9 +1,23 @@
 import unittest
+from unittest import mock
 from mp2stix import *
 from tempfile import TemporaryDirectory
 from stix2 import Report
 import stix2
 import uuid
+import os, subprocess, sys, io, contextlib
+
+IMPORT_TIME_FACTOR = 3
+HEAVY_MODULES = [
+    "requests",
+    "bs4",
+    "lxml",
+    "parsedatetime",
+    "bibtexparser",
+    "dateutil",
+    "stix2",
+    "resource",
+]
 
 
 class BrokerTest(unittest.TestCase):
@@ -12,6 +26,31 @@ class BrokerTest(unittest.TestCase):
 
     def tearDown(self):
         self.tmpdir.cleanup()
+        HOST_FAILURES.clear()
+        DATE_STRATEGIES.clear()
+        start_metadata_deadline(None)
+
+    def test_import_time(self):
+        code = "import sys, mp2stix\nprint(','.join(m for m in %r if m in sys.modules))"
+
+        def run(code):
+            start = time.perf_counter()
+            output = subprocess.run(
+                [sys.executable, "-c", code],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            return time.perf_counter() - start, output
+
+        timings = []
+        for _ in range(3):
+            elapsed, output = run(code % HEAVY_MODULES)
+            self.assertEqual(output.splitlines(), [""])
+            timings.append(elapsed)
+        baseline = min(run("pass")[0] for _ in range(3))
+        self.assertLess(min(timings), IMPORT_TIME_FACTOR * baseline)
 
     def test_disambiguate_aliases(self):
         tests = [
@@ -80,6 +119,481 @@ class BrokerTest(unittest.TestCase):
                     ]
                 )
 
+    def test_iter_bundle(self):
+        tests = [
+            {
+                "families": {
+                    "mw1": {
+                        "updated": "1.1.1970",
+                        "description": "",
+                        "alt_names": [],
+                        "common_name": "MW1",
+                        "attribution": ["attacker1", "Attacker1"],
+                        "urls": ["http://example.com"],
+                    },
+                    "mw2": {
+                        "updated": "1.1.1970",
+                        "description": "",
+                        "alt_names": [],
+                        "common_name": "MW2",
+                        "attribution": ["attacker1"],
+                        "urls": [],
+                    },
+                },
+                "misp": {"values": []},
+                "references": {
+                    "http://example.com": {"date": "01-10-2004", "title": "{Hallo}"}
+                },
+                "result": [
+                    "identity",
+                    "intrusion-set",
+                    "malware",
+                    "malware",
+                    "relationship",
+                    "relationship",
+                    "report",
+                ],
+                "progress": [
+                    ("families", 1, 2),
+                    ("families", 2, 2),
+                    ("reports", 1, 1),
+                ],
+            }
+        ]
+
+        for test in tests:
+            progress = []
+            result = iter_bundle(
+                test["families"],
+                test["misp"],
+                test["references"],
+                consume_sources=True,
+                progress=lambda *args: progress.append(args),
+            )
+            with mock.patch(
+                "mp2stix.resolve_metadata", wraps=resolve_metadata
+            ) as resolver:
+                first = [next(result)["type"] for _ in range(3)]
+                self.assertEqual(first, test["result"][:3])
+                self.assertFalse(resolver.called)
+                result = first + [o["type"] for o in result]
+                self.assertTrue(resolver.called)
+            self.assertEqual(result, test["result"])
+            self.assertEqual(progress, test["progress"])
+            self.assertEqual(test["families"], {})
+
+    def test_iter_malpedia_stix(self):
+        tests = [
+            {
+                "sources": (
+                    {
+                        "mw1": {
+                            "updated": "",
+                            "description": "",
+                            "alt_names": [],
+                            "common_name": "MW1",
+                            "attribution": [],
+                            "urls": [],
+                        }
+                    },
+                    {"values": []},
+                    {},
+                ),
+                "host_failures": {"tarpit.invalid": HOST_MAX_FAILURES},
+                "result": ["identity", "malware"],
+            }
+        ]
+
+        for test in tests:
+            HOST_FAILURES.update(test["host_failures"])
+            with mock.patch(
+                "mp2stix.load_sources", return_value=test["sources"]
+            ), mock.patch("mp2stix.load_date_strategies"), mock.patch(
+                "mp2stix.save_date_strategies"
+            ):
+                result = [o["type"] for o in iter_malpedia_stix()]
+            self.assertEqual(result, test["result"])
+            self.assertEqual(HOST_FAILURES, {})
+
+    def test_aiter_malpedia_stix_cancel(self):
+        import asyncio, threading
+
+        tests = [{"received": [0], "cancelled": [True]}]
+
+        for test in tests:
+            in_step = threading.Event()
+            cancelled, closed = [], []
+
+            def blocking_objs(cancel=None, **kwargs):
+                try:
+                    yield 0
+                    in_step.set()
+                    # blocks the build step until the consumer is cancelled
+                    cancelled.append(cancel.wait(10))
+                    yield 1
+                finally:
+                    closed.append(True)
+
+            async def consume(received):
+                async for obj in aiter_malpedia_stix():
+                    received.append(obj)
+
+            async def cancel():
+                received = []
+                task = asyncio.ensure_future(consume(received))
+                await asyncio.get_running_loop().run_in_executor(None, in_step.wait)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+                return received
+
+            with mock.patch("mp2stix.iter_malpedia_stix", side_effect=blocking_objs):
+                received = asyncio.run(cancel())
+            self.assertEqual(received, test["received"])
+            self.assertEqual(cancelled, test["cancelled"])
+            self.assertEqual(closed, [True])
+            self.assertIsNone(metadata_time_left())
+
+    def test_build_bundle_resume(self):
+        tests = [
+            {
+                "families": {
+                    "mw1": {
+                        "updated": "",
+                        "description": "",
+                        "alt_names": [],
+                        "common_name": "MW1",
+                        "attribution": ["attacker1"],
+                        "urls": ["http://example.com"],
+                    },
+                    "mw2": {
+                        "updated": "1.1.1970",
+                        "description": "",
+                        "alt_names": [],
+                        "common_name": "MW2",
+                        "attribution": ["attacker1"],
+                        "urls": ["https://www.example.com/"],
+                    },
+                },
+                "misp": {"values": []},
+                "references": {
+                    "http://example.com": {"date": "01-10-2004", "title": "{Hallo}"}
+                },
+                "families_done": ["mw1"],
+                "failed_url": "http://tarpit.invalid/blog",
+                "fallback": ("1970-01-01T00:00:00Z", "http://tarpit.invalid/blog"),
+            }
+        ]
+
+        for test in tests:
+            checkpoint = os.path.join(self.tmpdir.name, "bundle.checkpoint.json")
+            done = {key: test["families"][key] for key in test["families_done"]}
+            build_bundle(done, test["misp"], test["references"], checkpoint=checkpoint)
+            _, checkpointed, _ = load_checkpoint(checkpoint)
+            uninterrupted = build_bundle(
+                test["families"], test["misp"], test["references"]
+            )
+            result = build_bundle(
+                test["families"],
+                test["misp"],
+                test["references"],
+                checkpoint=checkpoint,
+                resume=True,
+            )
+            self.assertEqual(
+                sorted(o["id"] for o in result), sorted(o["id"] for o in uninterrupted)
+            )
+            for obj in checkpointed:
+                self.assertIn(obj, result)
+            with self.assertRaises(ValueError):
+                build_bundle(
+                    {"mw2": test["families"]["mw2"]},
+                    test["misp"],
+                    test["references"],
+                    checkpoint=checkpoint,
+                    resume=True,
+                )
+            result = build_bundle(
+                test["families"], test["misp"], test["references"], resume=True
+            )
+            self.assertEqual(
+                sorted(o["id"] for o in result), sorted(o["id"] for o in uninterrupted)
+            )
+            families = {"mw3": dict(test["families"]["mw1"], urls=[test["failed_url"]])}
+            save_checkpoint(checkpoint, [], [], {test["failed_url"]: test["fallback"]})
+            HOST_FAILURES[url_host(test["failed_url"])] = HOST_MAX_FAILURES
+            with mock.patch(
+                "mp2stix.resolve_metadata", wraps=resolve_metadata
+            ) as resolver:
+                build_bundle(
+                    families,
+                    test["misp"],
+                    test["references"],
+                    checkpoint=checkpoint,
+                    resume=True,
+                )
+            self.assertEqual(resolver.call_args.args[0], [test["failed_url"]])
+
+    def test_save_checkpoint(self):
+        tests = [
+            {
+                "families_done": ["mw1"],
+                "bundle": [
+                    Report(
+                        id="report--" + str(uuid.uuid4()),
+                        name="name1",
+                        object_refs=["indicator--" + str(uuid.uuid4())],
+                        published="1970-01-01T00:00:00Z",
+                    )
+                ],
+                "metadata": {"http://example.com": ("1970-01-01T00:00:00Z", "Example")},
+            }
+        ]
+
+        for test in tests:
+            path = os.path.join(self.tmpdir.name, "bundle.checkpoint.json")
+            save_checkpoint(
+                path, test["families_done"], test["bundle"], test["metadata"]
+            )
+            result = load_checkpoint(path)
+            self.assertEqual(
+                result, (test["families_done"], test["bundle"], test["metadata"])
+            )
+
+    def test_compact_sources(self):
+        tests = [
+            {
+                "misp": {
+                    "values": [
+                        {
+                            "value": "name1",
+                            "uuid": "<uuid>",
+                            "description": "<description>",
+                            "meta": {"synonyms": ["name1a"], "refs": ["<ref>"]},
+                        },
+                        {"value": "name2", "meta": {"country": "<country>"}},
+                    ]
+                },
+                "references": {
+                    "http://example.com": {
+                        "ID": "<id>",
+                        "date": "01-10-2004",
+                        "title": "{Hallo}",
+                        "url": "http://example.com",
+                    }
+                },
+                "result": (
+                    {
+                        "values": [
+                            {
+                                "value": "name1",
+                                "description": "<description>",
+                                "meta": {"synonyms": ["name1a"]},
+                            },
+                            {"value": "name2"},
+                        ]
+                    },
+                    {"http://example.com": {"date": "01-10-2004", "title": "{Hallo}"}},
+                ),
+            }
+        ]
+
+        for test in tests:
+            result = compact_sources(test["misp"], test["references"])
+            self.assertEqual(result, test["result"])
+
+    def test_stream_bundle(self):
+        tests = [
+            {"lines": [], "result": []},
+            {
+                "lines": ['{"id": "id1", "type": "malware"}\n', '{"id": "id2"}\n'],
+                "result": [{"id": "id1", "type": "malware"}, {"id": "id2"}],
+            },
+        ]
+
+        for test in tests:
+            path = os.path.join(self.tmpdir.name, "bundle.json")
+            stream_bundle(test["lines"], path)
+            with open(path) as f:
+                result = json.load(f)
+            self.assertEqual(result["type"], "bundle")
+            self.assertTrue(result["id"].startswith("bundle--"))
+            self.assertEqual(result["objects"], test["result"])
+
+    def test_merge_versions(self):
+        published = Report(
+            name="name1",
+            description="tests descr",
+            object_refs=["indicator--" + str(uuid.uuid4())],
+            published="1970-01-01T00:00:00Z",
+        )
+        tests = [
+            {
+                "published": {published["id"]: published},
+                "bundle": [Report(**{**published, "created": None, "modified": None})],
+                "result": [("name1", "tests descr")],
+                "changed": [],
+            },
+            {
+                "published": {published["id"]: published},
+                "bundle": [published.new_version(name="name2", description=None)],
+                "result": [("name2", None)],
+                "changed": [("name2", None)],
+            },
+            {
+                "published": {},
+                "bundle": [published],
+                "result": [("name1", "tests descr")],
+                "changed": [("name1", "tests descr")],
+            },
+        ]
+
+        for test in tests:
+            result, changed = merge_versions(test["published"], test["bundle"])
+            for objs, expected in (
+                (result, test["result"]),
+                (changed, test["changed"]),
+            ):
+                self.assertEqual(
+                    [(o["name"], o.get("description")) for o in objs], expected
+                )
+                for obj in objs:
+                    self.assertEqual(obj["id"], published["id"])
+                    self.assertEqual(obj["created"], published["created"])
+
+    def test_publish_update(self):
+        report = Report(
+            name="name1",
+            object_refs=["indicator--" + str(uuid.uuid4())],
+            published="1970-01-01T00:00:00Z",
+        )
+        removed = Report(
+            name="name2",
+            object_refs=["indicator--" + str(uuid.uuid4())],
+            published="1970-01-01T00:00:00Z",
+        )
+        tests = [
+            {
+                "published": {removed["id"]: removed},
+                "bundle": [report],
+                "objects": [report["id"]],
+                "delta": [report["id"]],
+                "removed": [removed["id"]],
+            }
+        ]
+
+        for test in tests:
+            path = os.path.join(self.tmpdir.name, "bundle.json")
+            delta_path = os.path.join(self.tmpdir.name, "bundle.delta.json")
+            result = publish_update(test["published"], test["bundle"], path, delta_path)
+            self.assertEqual(list(result), test["objects"])
+            self.assertEqual(list(load_published(path)), test["objects"])
+            with open(delta_path) as f:
+                delta = json.load(f)
+            self.assertEqual([o["id"] for o in delta["objects"]], test["delta"])
+            self.assertEqual(delta["removed"], test["removed"])
+
+    def test_run_daemon(self):
+        families = {
+            key: {"common_name": key, "alt_names": [], "attribution": [], "urls": []}
+            for key in ("mw1", "mw2")
+        }
+        sources = {
+            URL_FAMILIES: json.dumps(families).encode(),
+            URL_MISP: b'{"values": []}',
+            URL_BIBTEX: b"",
+        }
+
+        def get(url, headers, timeout):
+            response = mock.Mock(
+                status_code=200, content=sources[url], headers={"ETag": "v1"}
+            )
+            response.json.side_effect = lambda: json.loads(sources[url])
+            return response
+
+        tests = [
+            {
+                "build": [RuntimeError("build failed"), []],
+                "cycles": 3,
+                "builds": 2,
+                "selection": {"keys": ["mw1"]},
+                "families": ["mw1"],
+            }
+        ]
+
+        for test in tests:
+            path = os.path.join(self.tmpdir.name, "bundle.json")
+            delta_path = os.path.join(self.tmpdir.name, "bundle.delta.json")
+            sleeps = [None] * (test["cycles"] - 1) + [KeyboardInterrupt]
+            with mock.patch("requests.get", side_effect=get), mock.patch(
+                "mp2stix.build_bundle", side_effect=test["build"]
+            ) as build, mock.patch("mp2stix.parse_references"), mock.patch(
+                "mp2stix.save_date_strategies"
+            ), mock.patch(
+                "time.sleep", side_effect=sleeps
+            ):
+                with self.assertRaises(KeyboardInterrupt):
+                    run_daemon(0, path, delta_path, selection=test["selection"])
+            self.assertEqual(build.call_count, test["builds"])
+            self.assertEqual(list(build.call_args.args[0]), test["families"])
+
+    def test_expire_fallback_metadata(self):
+        tests = [
+            {
+                "metadata": {
+                    "http://example.invalid/files/annual_report.pdf": (
+                        "1970-01-01T00:00:00Z",
+                        "annual_report",
+                    ),
+                    "http://tarpit.invalid/blog": (
+                        "1970-01-01T00:00:00Z",
+                        "http://tarpit.invalid/blog",
+                    ),
+                    "http://example.invalid/blog": ("2004-10-01T00:00:00Z", "Blog"),
+                },
+                "result": {
+                    "http://example.invalid/blog": ("2004-10-01T00:00:00Z", "Blog")
+                },
+            }
+        ]
+
+        for test in tests:
+            expire_fallback_metadata(test["metadata"])
+            self.assertEqual(test["metadata"], test["result"])
+
+    def test_publish_update_reloaded(self):
+        tests = [
+            {
+                "families": {
+                    "mw1": {
+                        "updated": "1.1.1970",
+                        "description": "",
+                        "alt_names": [],
+                        "common_name": "MW1",
+                        "attribution": ["attacker1"],
+                        "urls": ["http://example.com"],
+                    }
+                },
+                "misp": {"values": []},
+                "references": {
+                    "http://example.com": {"date": "01-10-2004", "title": "{Hallo}"}
+                },
+            }
+        ]
+
+        for test in tests:
+            path = os.path.join(self.tmpdir.name, "bundle.json")
+            delta_path = os.path.join(self.tmpdir.name, "bundle.delta.json")
+            bundle = build_bundle(test["families"], test["misp"], test["references"])
+            publish_update({}, bundle, path, delta_path)
+            published = load_published(path)
+            rebuilt = build_bundle(test["families"], test["misp"], test["references"])
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                result = publish_update(published, rebuilt, path, delta_path)
+            self.assertEqual(output.getvalue(), "No changes to publish.\n")
+            self.assertIs(result, published)
+
     def test_integrate_new_objs(self):
         tests = [
             {
@@ -96,6 +610,42 @@ class BrokerTest(unittest.TestCase):
             for obj in test["results"]:
                 self.assertIn(obj, result)
 
+    def test_select_families(self):
+        families = {
+            "win.mw1": {
+                "common_name": "MW1",
+                "alt_names": ["Loader1"],
+                "attribution": ["Attacker1"],
+                "urls": ["https://example.com/report1"],
+            },
+            "win.mw2": {
+                "common_name": "MW2",
+                "alt_names": [],
+                "attribution": [],
+                "urls": ["http://www.example.com/report1/"],
+            },
+            "elf.mw3": {
+                "common_name": "MW3",
+                "alt_names": [],
+                "attribution": ["Attacker2"],
+                "urls": ["https://example.com/report3"],
+            },
+        }
+        tests = [
+            {"selection": {"keys": ["elf.mw3"]}, "result": ["elf.mw3"]},
+            {"selection": {"patterns": ["^loader"]}, "result": ["win.mw1"]},
+            {"selection": {"patterns": ["^win\\."]}, "result": ["win.mw1", "win.mw2"]},
+            {"selection": {"actors": ["attacker2"]}, "result": ["elf.mw3"]},
+            {
+                "selection": {"actors": ["ATTACKER1"], "shared_reports": True},
+                "result": ["win.mw1", "win.mw2"],
+            },
+        ]
+
+        for test in tests:
+            result = select_families(families, **test["selection"])
+            self.assertEqual(list(result), test["result"])
+
     def test_build_malware(self):
         tests = [
             {
@@ -130,26 +680,99 @@ class BrokerTest(unittest.TestCase):
             result_dict = {k: str(result[k]) for k in result if k != "id"}
             self.assertEqual(result_dict, test["result"])
 
-    def test_build_intrusion_sets(self):
+    def test_plan_attributions(self):
         tests = [
             {
-                "malware": {"attribution": {"attacker1", "attacker2"}},
-                "misp": {"values": {}},
+                "families": {
+                    "mw1": {"attribution": ["attacker1", "attacker2"], "updated": ""},
+                    "mw2": {"attribution": ["attacker1"], "updated": "1.1.1970"},
+                },
+                "pairs": [
+                    ("attacker1", "mw1"),
+                    ("attacker2", "mw1"),
+                    ("attacker1", "mw2"),
+                ],
+                "updated": {"mw1": "", "mw2": "1.1.1970"},
+            }
+        ]
+
+        for test in tests:
+            pairs, updated = plan_attributions(test["families"])
+            self.assertEqual(pairs, test["pairs"])
+            self.assertEqual(updated, test["updated"])
+
+    def test_resolve_intrusion_sets(self):
+        tests = [
+            {
+                "pairs": [
+                    ("attacker1", "mw1"),
+                    ("attacker2", "mw1"),
+                    ("Attacker1", "mw2"),
+                ],
+                "misp": {"values": [{"value": "Attacker1", "description": "<descr>"}]},
                 "bundle": [{"type": "intrusion-set", "name": "Attacker2"}],
+                "result": {
+                    "attacker1": {"name": "attacker1", "type": "intrusion-set"},
+                    "attacker2": {"name": "Attacker2", "type": "intrusion-set"},
+                },
+            }
+        ]
+
+        for test in tests:
+            result = resolve_intrusion_sets(test["pairs"], test["misp"], test["bundle"])
+            self.assertEqual(
+                {k: {"name": o["name"], "type": o["type"]} for k, o in result.items()},
+                test["result"],
+            )
+            self.assertTrue(result["attacker1"]["description"].startswith("<descr>"))
+
+    def test_build_all_relationships(self):
+        intrusion_sets = {
+            "attacker1": {"id": "intrusion-set--11111111-1111-1111-b111-111111111111"},
+            "attacker2": {"id": "intrusion-set--22222222-2222-2222-b222-222222222222"},
+        }
+        malwares = {
+            "mw1": {"id": "malware--11111111-1111-1111-a111-111111111111"},
+            "mw2": {"id": "malware--22222222-2222-2222-a222-222222222222"},
+        }
+        tests = [
+            {
+                "pairs": [
+                    ("attacker1", "mw1"),
+                    ("Attacker1", "mw1"),
+                    ("attacker2", "mw1"),
+                    ("attacker1", "mw2"),
+                ],
+                "updated": {"mw1": "", "mw2": "1.1.1970"},
                 "result": [
-                    {"name": "Attacker2", "type": "intrusion-set"},
-                    {"name": "attacker1", "type": "intrusion-set"},
+                    (intrusion_sets["attacker1"]["id"], malwares["mw1"]["id"], None),
+                    (intrusion_sets["attacker2"]["id"], malwares["mw1"]["id"], None),
+                    (
+                        intrusion_sets["attacker1"]["id"],
+                        malwares["mw2"]["id"],
+                        "1970-01-01 00:00:00",
+                    ),
                 ],
             }
         ]
 
         for test in tests:
-            result = build_intrusion_sets(test["malware"], test["misp"], test["bundle"])
-            result = [{"name": obj["name"], "type": obj["type"]} for obj in result]
-            for obj in result:
-                self.assertIn(obj, test["result"])
-            for obj in test["result"]:
-                self.assertIn(obj, result)
+            result = build_all_relationships(
+                test["pairs"], test["updated"], malwares, intrusion_sets
+            )
+            result = [
+                (
+                    rel["source_ref"],
+                    rel["target_ref"],
+                    (
+                        str(rel["created"])
+                        if "Last update" in rel["description"]
+                        else None
+                    ),
+                )
+                for rel in result
+            ]
+            self.assertEqual(result, test["result"])
 
     def test_compile_intrusion_set(self):
         tests = [
@@ -221,93 +844,63 @@ class BrokerTest(unittest.TestCase):
                 self.assertIn(rel_dict, test["result"])
                 self.assertTrue(isinstance(rel, stix2.v21.sro.Relationship))
 
-    def test_build_reports(self):
+    def test_plan_urls(self):
         tests = [
             {
-                "malware": {"id": "malware--8f20728a-7e18-4f46-b8e0-0e3d0eebb4d7"},
-                "mp_obj": {"urls": ["http://example.com"]},
-                "bundle": [
-                    Report(
-                        id="report--" + str(uuid.uuid4()),
-                        name="name1",
-                        description="tests descr",
-                        object_refs=["indicator--" + str(uuid.uuid4())],
-                        external_references=[
-                            {"url": "http://example.com", "source_name": "Example"}
-                        ],
-                        labels=["threat-report"],
-                        published="1970-01-01T00:00:00Z",
-                        confidence=95,
-                    ),
-                    Report(
-                        id="report--" + str(uuid.uuid4()),
-                        name="name2",
-                        description="tests descr",
-                        object_refs=["indicator--" + str(uuid.uuid4())],
-                        external_references=[
-                            {"url": "http://example2.com", "source_name": "Example2"}
-                        ],
-                        labels=["threat-report"],
-                        published="1970-01-01T00:00:00Z",
-                        confidence=95,
-                    ),
-                ],
-                "references": {
-                    "http://example.com": {
-                        "date": "01-10-2004",
-                        "language": "English",
-                        "organization": "Heise",
-                        "title": "{Hallo}",
-                    }
+                "families": {
+                    "mw1": {
+                        "urls": [
+                            "http://example.com/report/",
+                            "https://www.example.com/report#intro",
+                        ]
+                    },
+                    "mw2": {
+                        "urls": [
+                            "https://example.com/report?utm_source=feed",
+                            "https://example2.com/report",
+                        ]
+                    },
                 },
-                "result": [
-                    {
-                        "type": "report",
-                        "spec_version": "2.1",
-                        "name": "name1",
-                        "description": "tests descr",
-                        "published": "1970-01-01T00:00:00Z",
-                        "object_refs": [
-                            "indicator--c623c031-b7e7-4892-a88d-9d5752096b88",
-                            "malware--8f20728a-7e18-4f46-b8e0-0e3d0eebb4d7",
-                        ],
-                        "labels": ["threat-report"],
-                        "confidence": 95,
-                        "external_references": [
-                            {"source_name": "Example", "url": "http://example.com"}
-                        ],
-                    }
-                ],
+                "references": {"https://example.com/report?utm_source=feed": {}},
+                "urls": {
+                    "example.com/report": "https://example.com/report?utm_source=feed",
+                    "example2.com/report": "https://example2.com/report",
+                },
+                "url_families": {
+                    "example.com/report": ["mw1", "mw2"],
+                    "example2.com/report": ["mw2"],
+                },
+            }
+        ]
+
+        for test in tests:
+            urls, url_families = plan_urls(test["families"], test["references"])
+            self.assertEqual(urls, test["urls"])
+            self.assertEqual(url_families, test["url_families"])
+
+    def test_canonicalize_url(self):
+        tests = [
+            {"url": "https://www.Example.com/report/", "result": "example.com/report"},
+            {"url": "http://example.com:80/report", "result": "example.com/report"},
+            {
+                "url": "https://example.com/report?id=1&utm_medium=rss#top",
+                "result": "example.com/report?id=1",
             },
+            {"url": " http://[bad/x ", "result": "http://[bad/x"},
+        ]
+
+        for test in tests:
+            self.assertEqual(canonicalize_url(test["url"]), test["result"])
+
+    def test_build_reports(self):
+        tests = [
             {
-                "malware": {"id": "malware--8f20728a-7e18-4f46-b8e0-0e3d0eebb4d7"},
-                "mp_obj": {"urls": ["http://example.com"]},
-                "bundle": [
-                    Report(
-                        id="report--" + str(uuid.uuid4()),
-                        name="name1",
-                        description="tests descr",
-                        object_refs=["indicator--" + str(uuid.uuid4())],
-                        external_references=[
-                            {"url": "http://example.com", "source_name": "Example"}
-                        ],
-                        labels=["threat-report"],
-                        published="1970-01-01T00:00:00Z",
-                        confidence=95,
-                    ),
-                    Report(
-                        id="report--" + str(uuid.uuid4()),
-                        name="name2",
-                        description="tests descr",
-                        object_refs=["indicator--" + str(uuid.uuid4())],
-                        external_references=[
-                            {"url": "http://example2.com", "source_name": "Example2"}
-                        ],
-                        labels=["threat-report"],
-                        published="1970-01-01T00:00:00Z",
-                        confidence=95,
-                    ),
-                ],
+                "malwares": {
+                    "mw1": {"id": "malware--8f20728a-7e18-4f46-b8e0-0e3d0eebb4d7"},
+                    "mw2": {"id": "malware--a9f5d9b5-5f13-415e-8f15-e54f2e64da72"},
+                },
+                "urls": {"example.com": "http://example.com"},
+                "url_families": {"example.com": ["mw1", "mw2"]},
                 "references": {
                     "http://example.com": {
                         "date": "01-10-2004",
@@ -316,85 +909,38 @@ class BrokerTest(unittest.TestCase):
                         "title": "{Hallo}",
                     }
                 },
+                "bundle": [{"type": "report", "name": "Hallo"}],
                 "result": [
                     {
-                        "type": "report",
-                        "spec_version": "2.1",
-                        "name": "name1",
-                        "description": "tests descr",
-                        "published": "1970-01-01T00:00:00Z",
+                        "name": "Hallo (1)",
                         "object_refs": [
-                            "indicator--aba91e30-94ff-40ee-af60-4e4aebd6b91e",
                             "malware--8f20728a-7e18-4f46-b8e0-0e3d0eebb4d7",
+                            "malware--a9f5d9b5-5f13-415e-8f15-e54f2e64da72",
                         ],
-                        "labels": ["threat-report"],
-                        "confidence": 95,
                         "external_references": [
-                            {"source_name": "Example", "url": "http://example.com"}
+                            {"source_name": "Hallo", "url": "http://example.com"}
                         ],
                     }
                 ],
-            },
+            }
         ]
 
         for test in tests:
             result = build_reports(
-                test["malware"], test["mp_obj"], test["bundle"], test["references"]
+                test["malwares"],
+                test["urls"],
+                test["url_families"],
+                test["references"],
+                test["bundle"],
             )
-            for obj in test["result"]:
-                self.assertTrue(
-                    [o for o in result if [o[key] == obj[key] for key in obj]]
-                )
-
-    def test_add_object_ref(self):
-        tests = [
-            {
-                "obj_ref_list": [
-                    "indicator--945e1938-5605-44c9-a272-213728e1826f",
-                    "malware--a9f5d9b5-5f13-415e-8f15-e54f2e64da72",
-                ],
-                "malware": {"id": "malware--8f20728a-7e18-4f46-b8e0-0e3d0eebb4d7"},
-                "result": [
-                    {
-                        "indicator--945e1938-5605-44c9-a272-213728e1826f",
-                        "malware--a9f5d9b5-5f13-415e-8f15-e54f2e64da72",
-                        "malware--8f20728a-7e18-4f46-b8e0-0e3d0eebb4d7",
-                    }
-                ],
-            },
-            {
-                "obj_ref_list": [
-                    "indicator--945e1938-5605-44c9-a272-213728e1826f",
-                    "malware--8f20728a-7e18-4f46-b8e0-0e3d0eebb4d7",
-                ],
-                "malware": {"id": "malware--8f20728a-7e18-4f46-b8e0-0e3d0eebb4d7"},
-                "result": [
-                    {
-                        "indicator--945e1938-5605-44c9-a272-213728e1826f",
-                        "malware--8f20728a-7e18-4f46-b8e0-0e3d0eebb4d7",
-                    }
-                ],
-            },
-        ]
-
-        for test in tests:
-            reports = [
-                Report(
-                    id="report--" + str(uuid.uuid4()),
-                    name="test_name",
-                    description="tests descr",
-                    object_refs=test["obj_ref_list"],
-                    external_references=[
-                        {"source_name": "heise", "url": "http://www.heise.de"}
-                    ],
-                    labels=["threat-report"],
-                    published="1970-01-01T00:00:00Z",
-                    confidence=95,
-                )
+            result = [
+                {
+                    key: json.loads(json.dumps(o[key], default=dict))
+                    for key in test["result"][0]
+                }
+                for o in result
             ]
-            result = add_object_ref(reports, test["malware"])
-            for report in result:
-                self.assertIn(set(report["object_refs"]), test["result"])
+            self.assertEqual(result, test["result"])
 
     def test_compile_report(self):
         tests = [
@@ -431,12 +977,190 @@ class BrokerTest(unittest.TestCase):
             for key in test["result"]:
                 self.assertEqual(str(test["result"][key]), result_dict[key])
 
-    def test_get_date_from_html(self):
-        tests = [{"html": "<date>1.1.1970</date>", "result": "1970-01-01T00:00:00Z"}]
+    def test_fetch_url(self):
+        tests = [
+            {
+                "url": "http://tarpit.invalid/report.html",
+                "host_failures": {"tarpit.invalid": HOST_MAX_FAILURES},
+                "deadline": None,
+            },
+            {
+                "url": "http://example.invalid/report.html",
+                "host_failures": {},
+                "deadline": 0,
+            },
+        ]
+
+        for test in tests:
+            HOST_FAILURES.clear()
+            HOST_FAILURES.update(test["host_failures"])
+            start_metadata_deadline(test["deadline"])
+            self.assertIsNone(fetch_url(test["url"]))
+            self.assertEqual(
+                get_alt_meta(test["url"]), ("1970-01-01T00:00:00Z", "report")
+            )
+
+        cancel = threading.Event()
+        cancel.set()
+        start_metadata_deadline(None)
+        with mock.patch("requests.get") as get:
+            self.assertIsNone(fetch_url("http://example.invalid/report.html", cancel))
+        get.assert_not_called()
+
+    def test_fetch_url_retries(self):
+        import requests
+
+        ok, unavailable = mock.Mock(status_code=200), mock.Mock(status_code=503)
+        timeout = requests.exceptions.Timeout()
+        tests = [
+            {
+                "urls": ["http://example.invalid/report.html"],
+                "responses": [unavailable, timeout, ok],
+                "result": [ok],
+                "calls": 3,
+                "sleeps": [REQUESTS_BACKOFF, 2 * REQUESTS_BACKOFF],
+                "host_failures": {},
+            },
+            {
+                "urls": ["http://example.invalid/report.html"],
+                "responses": [unavailable] * 3,
+                "result": [unavailable],
+                "calls": 3,
+                "sleeps": [REQUESTS_BACKOFF, 2 * REQUESTS_BACKOFF],
+                "host_failures": {"example.invalid": 1},
+            },
+            {
+                "urls": [
+                    "http://tarpit.invalid/" + str(i) for i in range(HOST_MAX_FAILURES)
+                ]
+                + ["http://tarpit.invalid/skipped"],
+                "responses": [timeout] * (3 * HOST_MAX_FAILURES),
+                "result": [None] * (HOST_MAX_FAILURES + 1),
+                "calls": 3 * HOST_MAX_FAILURES,
+                "sleeps": [REQUESTS_BACKOFF, 2 * REQUESTS_BACKOFF] * HOST_MAX_FAILURES,
+                "host_failures": {"tarpit.invalid": HOST_MAX_FAILURES},
+            },
+        ]
 
         for test in tests:
-            result = get_date_from_html(test["html"])
+            HOST_FAILURES.clear()
+            with mock.patch(
+                "requests.get", side_effect=test["responses"]
+            ) as get, mock.patch("time.sleep") as sleep:
+                result = [fetch_url(url) for url in test["urls"]]
             self.assertEqual(result, test["result"])
+            self.assertEqual(get.call_count, test["calls"])
+            self.assertEqual([c.args[0] for c in sleep.call_args_list], test["sleeps"])
+            self.assertEqual(HOST_FAILURES, test["host_failures"])
+
+    def test_resolve_metadata(self):
+        tests = [
+            {
+                "urls": [
+                    "http://example.invalid/files/annual_report.pdf",
+                    "http://tarpit.invalid/blog",
+                ],
+                "host_failures": {"tarpit.invalid": HOST_MAX_FAILURES},
+                "result": {
+                    "http://example.invalid/files/annual_report.pdf": (
+                        "1970-01-01T00:00:00Z",
+                        "annual_report",
+                    ),
+                    "http://tarpit.invalid/blog": (
+                        "1970-01-01T00:00:00Z",
+                        "http://tarpit.invalid/blog",
+                    ),
+                },
+            }
+        ]
+
+        for test in tests:
+            HOST_FAILURES.update(test["host_failures"])
+            result = resolve_metadata(test["urls"], 2, 1)
+            self.assertEqual(result, test["result"])
+            self.assertEqual(DATE_STRATEGIES, {})
+
+    def test_resolve_metadata_errors(self):
+        urls = ["http://example.invalid/" + str(i) for i in range(20)]
+        tests = [
+            {
+                "on_resolved": None,
+                "result": {url: ("1970-01-01T00:00:00Z", url) for url in urls},
+            },
+            {
+                "on_resolved": mock.Mock(side_effect=RuntimeError("resolved failed")),
+                "result": RuntimeError,
+            },
+        ]
+
+        for test in tests:
+            # an undecodable body makes every parse worker raise
+            with mock.patch("mp2stix.fetch_body", return_value=(None, "utf-8")):
+                if test["result"] is RuntimeError:
+                    with self.assertRaises(RuntimeError):
+                        resolve_metadata(urls, 4, 2, 2, on_resolved=test["on_resolved"])
+                    continue
+                result = resolve_metadata(urls, 4, 2, 2)
+            self.assertEqual(result, test["result"])
+
+    def test_save_date_strategies(self):
+        tests = [{"strategies": {"example.com": "time", "example2.com": "class"}}]
+
+        for test in tests:
+            path = os.path.join(self.tmpdir.name, "date_strategies.json")
+            DATE_STRATEGIES.update(test["strategies"])
+            save_date_strategies(path)
+            DATE_STRATEGIES.clear()
+            load_date_strategies(path)
+            self.assertEqual(DATE_STRATEGIES, test["strategies"])
+
+    def test_parse_alt_meta(self):
+        tests = [
+            {
+                "url": "http://example.com/blog",
+                "body": (
+                    b"<html><title>Tom &amp; Jerry</title></html>",
+                    "utf-8",
+                ),
+                "result": ("1970-01-01T00:00:00Z", "Tom & Jerry", None),
+            },
+            {
+                "url": "http://example.com/blog",
+                "body": (b"<html><title>Caf\xc3\xa9</title></html>", "unknown-charset"),
+                "result": ("1970-01-01T00:00:00Z", "Caf\u00e9", None),
+            },
+            {
+                "url": "http://example.com/files/report.pdf",
+                "body": None,
+                "result": ("1970-01-01T00:00:00Z", "report", None),
+            },
+        ]
+
+        for test in tests:
+            result = parse_alt_meta(test["url"], test["body"])
+            self.assertEqual(result, test["result"])
+
+    def test_get_date_from_html(self):
+        html = (
+            "<time>March 3, 2020</time>"
+            "<span id='meta'>January 5, 2019</span>"
+            "<span datetime='x'>Word</span>"
+        )
+        tests = [
+            {
+                "html": "<date>1.1.1970</date>",
+                "strategy": None,
+                "result": ("1970-01-01", None),
+            },
+            {"html": html, "strategy": None, "result": ("2020-03-03", "time")},
+            {"html": html, "strategy": "id", "result": ("2019-01-05", "id")},
+            {"html": html, "strategy": "datetime", "result": ("2020-03-03", "time")},
+            {"html": html, "strategy": "unknown", "result": ("2020-03-03", "time")},
+        ]
+
+        for test in tests:
+            date, selector = get_date_from_html(test["html"], test["strategy"])
+            self.assertEqual((date[:10], selector), test["result"])
 
     def test_find_date_elements(self):
         tests = [